@@ -4,6 +4,7 @@ import logging
 import uuid
 from django.db import models
 from django.conf import settings
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.contrib.auth.models import Group, User
 from django.utils.html import format_html
@@ -236,6 +237,30 @@ class Annotation(models.Model):
         # NOTE: currently annotation model assumes user is not modified;
         # if it is changed, previous owner will still have permissions
         self.grant_user_access()
+        self.update_count_version()
+
+    def delete(self, *args, **kwargs):
+        """Extend default delete method to update the annotation
+        count version for the annotation owner."""
+        super(Annotation, self).delete(*args, **kwargs)
+        self.update_count_version()
+
+    #: cache key for the annotation count version for a user
+    COUNT_VERSION_CACHE_KEY = 'annotation-count-version-%s'
+
+    @classmethod
+    def count_version(cls, user):
+        '''Version identifier for annotations owned by a user, for use
+        in cache keys for annotation counts; changes whenever one of
+        the user's annotations is saved or deleted.'''
+        return cache.get(cls.COUNT_VERSION_CACHE_KEY % user.pk, '')
+
+    def update_count_version(self):
+        '''Update the annotation count version for the annotation owner,
+        so that any previously cached annotation counts are not used.'''
+        if self.user_id is not None:
+            cache.set(self.COUNT_VERSION_CACHE_KEY % self.user_id,
+                      uuid.uuid4().hex, None)
 
     def update_from_request(self, request):
         '''Update attributes from data in a
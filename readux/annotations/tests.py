@@ -2,6 +2,7 @@ import json
 from mock import Mock, patch
 import uuid
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
 from django.core.urlresolvers import reverse, resolve
 from django.test import TestCase
 from django.test.utils import override_settings
@@ -156,6 +157,20 @@ class AnnotationTestCase(TestCase):
         self.assertEqual(note.updated,
                          Annotation.objects.all().last_updated_time())
 
+    def test_count_version(self):
+        user = get_user_model().objects.get(username='testuser')
+        cache.clear()
+        self.assertEqual('', Annotation.count_version(user))
+
+        # version should change when a user's annotation is saved
+        note = Annotation(user=user, text='foo')
+        note.save()
+        version = Annotation.count_version(user)
+        self.assertNotEqual('', version)
+
+        # ... and when it is deleted
+        note.delete()
+        self.assertNotEqual(version, Annotation.count_version(user))
 
     def test_related_pages(self):
         note = Annotation.create_from_request(self.mockrequest)
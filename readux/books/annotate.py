@@ -1,20 +1,21 @@
 '''Methods to generate annotated TEI for export.'''
 
 from bs4 import BeautifulSoup
+from collections import defaultdict
 from datetime import datetime
 from django.conf import settings
-from django.contrib.auth import get_user_model
-from django.db.models import Q
 from django.utils.text import slugify
-from eulxml.xmlmap import load_xmlobject_from_string, teimap, \
-    load_xmlobject_from_file, XmlObject
+from eulxml.xmlmap import teimap, load_xmlobject_from_file, XmlObject
+from functools import wraps
 import logging
 from lxml import etree
 import mistune
 import os
+import re
 
 
 from readux import __version__
+from readux.annotations.models import Annotation
 from readux.books import tei, markdown_tei
 from readux.utils import absolutize_url
 
@@ -25,6 +26,57 @@ TEI_ENCODING_DESCRIPTION = os.path.join(
     os.path.dirname(__file__),
     'annotated_tei_encodingDesc.xml')
 
+#: parser for annotation content converted to TEI; reused for all notes
+#: rather than creating a new parser for each one
+_NOTE_PARSER = etree.XMLParser(resolve_entities=False, no_network=True)
+#: opening and closing tags used to wrap annotation content as a TEI note,
+#: with TEI as the default namespace
+_NOTE_WRAPPER_OPEN = ('<note xmlns="%s">' % teimap.TEI_NAMESPACE).encode('utf-8')
+_NOTE_WRAPPER_CLOSE = b'</note>'
+
+
+def _memoize(maxsize):
+    '''Decorator to cache the results of a single-argument function,
+    keyed on the argument.  The cache is cleared when it reaches
+    `maxsize` entries, to keep it from growing without limit across
+    exports.'''
+    def decorator(fn):
+        cache = {}
+
+        @wraps(fn)
+        def wrapper(arg):
+            result = cache.get(arg)
+            if result is None:
+                if len(cache) >= maxsize:
+                    cache.clear()
+                result = cache[arg] = fn(arg)
+            return result
+        wrapper.cache = cache
+        return wrapper
+    return decorator
+
+
+#: maximum number of compiled xpaths to cache in :meth:`_compiled_xpath`
+XPATH_CACHE_SIZE = 1024
+
+
+@_memoize(XPATH_CACHE_SIZE)
+def _compiled_xpath(expr):
+    '''Get a compiled :class:`lxml.etree.XPath` for a TEI xpath expression,
+    so that xpaths repeated across annotations are only compiled once.'''
+    return etree.XPath(expr, namespaces=tei.Zone.ROOT_NAMESPACES)
+
+
+#: maximum number of tag slugs to cache in :meth:`tag_slug`
+TAG_SLUG_CACHE_SIZE = 4096
+
+
+@_memoize(TAG_SLUG_CACHE_SIZE)
+def tag_slug(tag):
+    '''Slugify a tag for use as a TEI identifier.  Slugs are cached,
+    since the same tags are used repeatedly across annotations.'''
+    return slugify(tag)
+
 
 def annotated_tei(teivol, annotations):
     '''Takes a TEI :class:`~readux.books.tei.Facsimile` document and an
@@ -63,51 +115,82 @@ def annotated_tei(teivol, annotations):
 
     # update responsibility statement
     teivol.responsibility = 'annotated by'
+
+    # load all annotations in a single query, and group them by page ark
+    # so notes can be found for each page without querying the database
+    # again; iterate the results rather than caching them on the queryset,
+    # since the notes are kept in the page index
+    notes_by_ark = defaultdict(list)
     # get a distinct list of all annotation authors
     # NOTE: this will add users even if the annotations don't get
     # successfully added to the output
-    user_ids = annotations.only('user').order_by('user')\
-                       .values_list('user', flat=True).distinct()
-    users = get_user_model().objects.filter(id__in=user_ids)
-    for user in users:
+    # users are loaded with the annotations, so collect them by id
+    authors = {}
+    for note in annotations.select_related('user').iterator():
+        # page.href should either be local readux uri OR ARK uri;
+        # local uri is stored as annotation uri, but ark is in extra data
+        page_ark = note.extra_data.get('ark', '')
+        if not page_ark and settings.DEV_ENV:
+            # NOTE: allow without ark in dev, since test page records
+            # may not have ARKs
+            page_ark = note.uri
+        notes_by_ark[page_ark].append(note)
+        if note.user_id:
+            authors[note.user_id] = note.user
+
+    for user_id in sorted(authors):
+        user = authors[user_id]
         teivol.responsible_names.append(tei.Name(id=user.username,
                                                  value=user.get_full_name()))
 
     # publication statement - main info should already be set
     # update to reflect annotated tei and ensure date is current
     teivol.create_pubstmt()  # make sure publicationStmt exists
-    teivol.pubstmt.desc = 'Annotated TEI generated by Readux version %s' % __version__
+    # set values on the publicationStmt node directly rather than
+    # resolving each field xpath from the document
+    pubstmt_node = teivol.pubstmt.node
+    _tei_child(pubstmt_node, 'p').text = \
+        'Annotated TEI generated by Readux version %s' % __version__
     export_date = datetime.now()
-    teivol.pubstmt.date = export_date
-    teivol.pubstmt.date_normal = export_date
+    date_node = _tei_child(pubstmt_node, 'date')
+    # formats match tei.PublicationStatement date and date_normal
+    date_node.text = export_date.strftime('%B %d, %Y')
+    date_node.set('when', export_date.strftime('%Y-%m-%d'))
 
     # add stock encoding description
     teivol.encoding_desc = load_xmlobject_from_file(TEI_ENCODING_DESCRIPTION,
                                                     XmlObject)
 
-    for page in teivol.page_list:
+    # if there are no annotations, there is nothing else to add;
+    # skip going through the pages
+    if not notes_by_ark:
+        return teivol
+
+    # map page ARKs to TEI page ids, for linking related pages
+    page_list = teivol.page_list
+    page_ids = dict((page.href, page.id) for page in page_list if page.href)
+    # generate annotation url format once rather than for every note
+    url_format = annotation_url_format()
+
+    # annotations div is created by insert_note when the first note
+    # is added, and the node is then used directly to append notes
+    annotation_node = None
+
+    for page in page_list:
         # use page.href to find annotations for this page
         # if for some reason href is not set, skip this page
         if not page.href:
             continue
 
-        # page.href should either be local readux uri OR ARK uri;
-        # local uri is stored as annotation uri, but ark is in extra data
-        page_annotations = annotations.filter(Q(uri=page.href)|Q(extra_data__contains=page.href))
-
-        if page_annotations.exists():
-            for note in page_annotations:
-                # possible to get extra matches for page url in related pages,
-                # so skip any notes where ark doesn't match page url
-                if note.extra_data.get('ark', '') != page.href and not settings.DEV_ENV:
-                    # NOTE: allow without ark in dev, since test page records
-                    # may not have ARKs
-                    continue
-
-                insert_note(teivol, page, note)
-                # collect a list of unique tags as we work through the notes
-                if 'tags' in note.info():
-                    tags |= set(t.strip() for t in note.info()['tags'])
+        for note in notes_by_ark.get(page.href, ()):
+            # annotation info is used in several places; generate it once
+            info = note.info()
+            annotation_node = insert_note(teivol, page, note, info=info,
+                page_ids=page_ids, url_format=url_format,
+                annotation_node=annotation_node)
+            # collect a list of unique tags as we work through the notes
+            if info.get('tags'):
+                tags.update(t.strip() for t in info['tags'])
 
     consolidate_bibliography(teivol)
 
@@ -115,16 +198,48 @@ def annotated_tei(teivol, annotations):
     if tags:
         # create back matter interpgrp for annotation tags
         teivol.create_tags()
+        tags_node = teivol.tags.node
+        interp_tag = '{%s}interp' % teimap.TEI_NAMESPACE
+        xml_id = '{%s}id' % tei.TeiBase.ROOT_NAMESPACES['xml']
         for tag in tags:
+            # add interp elements directly with lxml, equivalent to
+            # tei.Interp(id=..., value=tag) without the xmlobject overhead
+            interp = etree.SubElement(tags_node, interp_tag)
             # NOTE: our tag implementation currently does not allow spaces,
             # but using slugify to generate ids to avoid any issues with spaces
             # and variation in capitalization or punctuation
-            teivol.tags.interp.append(tei.Interp(id=slugify(tag), value=tag))
+            interp.set(xml_id, tag_slug(tag))
+            interp.text = tag
 
     return teivol
 
 
-def annotation_to_tei(annotation, teivol):
+#: placeholder annotation id, used to generate :meth:`annotation_url_format`;
+#: must be a valid uuid to match the annotation url pattern
+_PLACEHOLDER_ID = '00000000-0000-4000-8000-000000000000'
+
+
+def annotation_url_format():
+    '''Format string for the absolute url of an annotation, with ``%s``
+    in place of the annotation id.  Allows generating urls for many
+    annotations without resolving and absolutizing the url for each one.'''
+    url = absolutize_url(Annotation(id=_PLACEHOLDER_ID).get_absolute_url())
+    # escape any literal % in the url before adding the placeholder
+    return url.replace('%', '%%').replace(_PLACEHOLDER_ID, '%s')
+
+
+def _tei_child(node, name):
+    '''Get the first TEI child element of a node with the specified
+    name, creating it if it does not exist.'''
+    tag = '{%s}%s' % (teimap.TEI_NAMESPACE, name)
+    child = node.find(tag)
+    if child is None:
+        child = etree.SubElement(node, tag)
+    return child
+
+
+def annotation_to_tei(annotation, teivol, info=None, page_ids=None,
+                      url_format=None):
     '''Generate a tei note from an annotation.  Sets annotation id,
     slugified tags as ana attribute, username as resp attribute, and
     annotation content is converted from markdown to TEI.
@@ -132,8 +247,19 @@ def annotation_to_tei(annotation, teivol):
     :param annotation: :class:`~readux.annotations.models.Annotation`
     :param teivol: :class:`~readux.books.tei.AnnotatedFacsimile` tei
         document, for converting related page ARK uris into TEI ids
+    :param info: optional annotation info, as returned by
+        :meth:`~readux.annotations.models.Annotation.info`; generated
+        from the annotation if not specified
+    :param page_ids: optional dictionary of TEI page ids keyed on page
+        ARK uri; if not specified, related page ids are looked up
+        in the tei document
+    :param url_format: optional format string for annotation urls, as
+        generated by :meth:`annotation_url_format`
     :returns: :class:`readux.books.tei.Note`
     '''
+    if info is None:
+        info = annotation.info()
+
     # NOTE: annotation created/edited dates are not included here
     # because they were determined not to be relevant for our purposes
 
@@ -145,19 +271,29 @@ def annotation_to_tei(annotation, teivol):
     # markdown results could be a list of paragraphs, and not a proper
     # xml tree; also, pags do not include namespace
     # wrap in a note element and set the default namespace as tei
-    teinote = load_xmlobject_from_string('<note xmlns="%s">%s</note>' % \
-        (teimap.TEI_NAMESPACE, note_content),
-        tei.Note)
+    if '<' in note_content or '&' in note_content:
+        # parse directly with lxml; no need for xmlobject parser setup
+        note_node = etree.fromstring(_NOTE_WRAPPER_OPEN +
+            note_content.encode('utf-8') + _NOTE_WRAPPER_CLOSE, _NOTE_PARSER)
+    else:
+        # no markup or entities, so no parsing needed
+        note_node = etree.Element('{%s}note' % teimap.TEI_NAMESPACE,
+                                  nsmap={None: teimap.TEI_NAMESPACE})
+        note_node.text = note_content
+    teinote = tei.Note(note_node)
 
     # what id do we want? annotation uuid? url?
     teinote.id = 'annotation-%s' % annotation.id  # can't start with numeric
-    teinote.href = absolutize_url(annotation.get_absolute_url())
+    if url_format is not None:
+        teinote.href = url_format % annotation.id
+    else:
+        teinote.href = absolutize_url(annotation.get_absolute_url())
     teinote.type = 'annotation'
 
     # if an annotation includes tags, reference them by slugified id in @ana
-    if 'tags' in annotation.info() and annotation.info()['tags']:
-        tags = ' '.join(set('#%s' % slugify(t.strip())
-                            for t in annotation.info()['tags']))
+    if info.get('tags'):
+        tags = ' '.join(set('#%s' % tag_slug(t.strip())
+                            for t in info['tags']))
         teinote.ana = tags
 
     # if the annotation has an associated user, mark the author
@@ -174,7 +310,10 @@ def annotation_to_tei(annotation, teivol):
         for rel_page in annotation.related_pages:
             page_ref = tei.Ref(text=rel_page, type='related page')
             # find tei page identifier from the page ark
-            target = teivol.page_id_by_xlink(rel_page)
+            if page_ids is not None:
+                target = page_ids.get(rel_page)
+            else:
+                target = teivol.page_id_by_xlink(rel_page)
             if target is not None:
                 page_ref.target = '#%s' % target
             teinote.related_pages.append(page_ref)
@@ -193,25 +332,37 @@ def annotation_to_tei(annotation, teivol):
                 bibl_struct['xml:id'] = 'zotero-%s' % \
                     bibl_struct['xml:id'].split('/')[-1]
 
-            teibibl = load_xmlobject_from_string(bibsoup.biblStruct.prettify(),
-                                                 tei.BiblStruct)
+            teibibl = tei.BiblStruct(etree.fromstring(
+                bibsoup.biblStruct.prettify(), _NOTE_PARSER))
             teinote.citations.append(teibibl)
 
     return teinote
 
 
+#: html xpath components and the equivalent TEI xpath components
+_HTML_TO_TEI_XPATH = {
+    'div': 'tei:zone',
+    # NOTE: span could match either line in abbyy ocr or word in mets/alto
+    'span': 'node()[local-name()="line" or local-name()="w"]',
+    '@id': '@xml:id',
+}
+_HTML_XPATH_RE = re.compile('|'.join(_HTML_TO_TEI_XPATH.keys()))
+#: maximum number of converted xpaths to cache in :meth:`html_xpath_to_tei`
+TEI_XPATH_CACHE_SIZE = 1024
+
+
+@_memoize(TEI_XPATH_CACHE_SIZE)
 def html_xpath_to_tei(xpath):
     '''Convert xpaths generated on the readux site to the
     equivalent xpaths for the corresponding TEI content,
     so that annotations created against the HTML can be matched to
     the corresponding TEI.'''
-    # NOTE: span could match either line in abbyy ocr or word in mets/alto
-    return xpath.replace('div', 'tei:zone') \
-                .replace('span', 'node()[local-name()="line" or local-name()="w"]') \
-                .replace('@id', '@xml:id')
+    return _HTML_XPATH_RE.sub(
+        lambda match: _HTML_TO_TEI_XPATH[match.group(0)], xpath)
 
 
-def insert_note(teivol, teipage, annotation):
+def insert_note(teivol, teipage, annotation, info=None, page_ids=None,
+                url_format=None, annotation_node=None):
     '''Insert an annotation and highlight reference into a tei document
     and tei facsimile page.
 
@@ -221,9 +372,22 @@ def insert_note(teivol, teipage, annotation):
         annotation highlight references should be added
     :param annotation: :class:`~readux.annotations.models.Annotation`
         to add the document
+    :param info: optional annotation info, as returned by
+        :meth:`~readux.annotations.models.Annotation.info`; generated
+        from the annotation if not specified
+    :param page_ids: optional dictionary of TEI page ids keyed on page
+        ARK uri, passed through to :meth:`annotation_to_tei`
+    :param url_format: optional format string for annotation urls,
+        passed through to :meth:`annotation_to_tei`
+    :param annotation_node: optional node for the annotations div in the
+        tei document; if specified, the note is appended to it directly,
+        otherwise the div is found or created when the note is added
+    :returns: node for the annotations div, for use with subsequent
+        notes (None if no note was added and no node was specified)
     '''
+    if info is None:
+        info = annotation.info()
 
-    info = annotation.info()
     # convert html xpaths to tei
     if 'ranges' in info and info['ranges']:
         # NOTE: assuming a single range selection for now
@@ -237,11 +401,16 @@ def insert_note(teivol, teipage, annotation):
         start_xpath = html_xpath_to_tei(selection_range['start']) or '//tei:zone[1]'
         end_xpath = html_xpath_to_tei(selection_range['end']) or '//tei:zone[last()]'
         # insert references using start and end xpaths & offsets
-        start = teipage.node.xpath(start_xpath, namespaces=tei.Zone.ROOT_NAMESPACES)
-        end = teipage.node.xpath(end_xpath, namespaces=tei.Zone.ROOT_NAMESPACES)
+        start = _compiled_xpath(start_xpath)(teipage.node)
+        # selections often start and end in the same element;
+        # only evaluate the xpath again if it is different
+        if end_xpath == start_xpath:
+            end = start
+        else:
+            end = _compiled_xpath(end_xpath)(teipage.node)
         if not start or not end:
             logger.warn('Could not find start or end xpath for annotation %s' % annotation.id)
-            return
+            return annotation_node
         else:
             # xpath returns a list of matches; we only want the first one
             start = start[0]
@@ -264,26 +433,25 @@ def insert_note(teivol, teipage, annotation):
     elif 'image_selection' in info:
         # for readux, image annotation can *only* be the page image
         # so not checking image uri
-        page_width = teipage.lrx - teipage.ulx
-        page_height = teipage.lry - teipage.uly
+        page_width = float(teipage.lrx - teipage.ulx)
+        page_height = float(teipage.lry - teipage.uly)
 
         # create a new zone for the image highlight
         image_highlight = tei.Zone(type="image-annotation-highlight")
         # image selection in annotation stored as percentages
         # convert ##% into a float that can be multiplied by page dimensions
-        selection = {
-            'x': float(info['image_selection']['x'].rstrip('%')) / 100,
-            'y': float(info['image_selection']['y'].rstrip('%')) / 100,
-            'w': float(info['image_selection']['w'].rstrip('%')) / 100,
-            'h': float(info['image_selection']['h'].rstrip('%')) / 100
-        }
+        image_selection = info['image_selection']
+        x, y, w, h = [float(image_selection[key].rstrip('%')) / 100
+                      for key in ('x', 'y', 'w', 'h')]
 
         # convert percentages into upper left and lower right coordinates
         # relative to the page
-        image_highlight.ulx = selection['x'] * float(page_width)
-        image_highlight.uly = selection['y'] * float(page_height)
-        image_highlight.lrx = image_highlight.ulx + (selection['w'] * page_width)
-        image_highlight.lry = image_highlight.uly + (selection['h'] * page_height)
+        ulx = x * page_width
+        uly = y * page_height
+        image_highlight.ulx = ulx
+        image_highlight.uly = uly
+        image_highlight.lrx = ulx + w * page_width
+        image_highlight.lry = uly + h * page_height
 
         image_highlight.id = 'highlight-%s' % annotation.id
         target = '#%s' % image_highlight.id
@@ -292,10 +460,17 @@ def insert_note(teivol, teipage, annotation):
 
     # call annotation_to_tei and insert the resulting note into
     # the appropriate part of the document
-    teinote = annotation_to_tei(annotation, teivol)
+    teinote = annotation_to_tei(annotation, teivol, info=info,
+                                page_ids=page_ids, url_format=url_format)
     teinote.target = target
-    # append actual annotation to tei annotations div
-    teivol.annotations.append(teinote)
+    # append actual annotation to tei annotations div, creating
+    # the div when the first note is added
+    if annotation_node is None:
+        if teivol.annotation_div is None:
+            teivol.create_annotation_div()
+        annotation_node = teivol.annotation_div.node
+    annotation_node.append(teinote.node)
+    return annotation_node
 
 
 def insert_anchor(element, anchor, offset):
@@ -309,10 +484,12 @@ def insert_anchor(element, anchor, offset):
     :param anchor: node for the anchor element
     :param offset: numeric offset into the element
     '''
-    if offset == 0:
+    # element may not have any text (e.g., empty word or line)
+    el_text = element.text or ''
+    if offset <= 0:
         # offset zero - insert directly before this element
         element.addprevious(anchor)
-    elif offset >= len(element.text):
+    elif offset >= len(el_text):
         # offset at end of this element - insert directly after
         element.addnext(anchor)
     else:
@@ -320,7 +497,6 @@ def insert_anchor(element, anchor, offset):
         # insert the element after the text and then break up
         # the lxml text and "tail" so that text after the offset
         # comes after the inserted anchor
-        el_text = element.text
         element.insert(0, anchor)
         element.text = el_text[:offset]
         anchor.tail = el_text[offset:]
@@ -1,12 +1,18 @@
 import logging
 import os.path
 import re
+import threading
 from bs4 import BeautifulSoup
 import mistune
 
 
 logger = logging.getLogger(__name__)
 
+# markdown parser is reused across calls, since setting up the parser
+# and renderer is significant for short texts; mistune resets its state
+# for each document, but parsing is not thread-safe, so keep one per thread
+_local = threading.local()
+
 
 def convert(text):
     '''Render markdown text as simple TEI.
@@ -15,7 +21,10 @@ def convert(text):
     content, and that it is not intended to be an entire, valid document
     on its own.
     '''
-    mkdown = mistune.Markdown(renderer=TeiMarkdownRenderer())
+    mkdown = getattr(_local, 'markdown', None)
+    if mkdown is None:
+        mkdown = _local.markdown = mistune.Markdown(
+            renderer=TeiMarkdownRenderer())
     return mkdown(TeiMarkdownRenderer.preprocess(text))
 
 
@@ -294,6 +294,20 @@ class Page(Image):
         if self.page_order is not None:
             data['page_order'] = self.page_order
 
+        # index image dimensions, so page layout can be determined
+        # from solr results without loading the page object;
+        # dimensions come from the IIIF image service, so skip them
+        # (rather than failing to index) if it can't be reached
+        try:
+            width, height = self.width, self.height
+        except requests.exceptions.RequestException as err:
+            logger.warn('Error retrieving image dimensions for %s: %s',
+                        self.pid, err)
+            width = height = None
+        if width is not None and height is not None:
+            data['page_width'] = width
+            data['page_height'] = height
+
         # if OCR text is available, index it as page fulltext, for searching & highlighting
         if self.has_fulltext():
             data['page_text'] = self.get_fulltext()
@@ -727,6 +741,14 @@ class Volume(DigitalObject, BaseVolume):
             if sorted_dates:
                 return sorted_dates[-1]
 
+    def iter_fulltext(self):
+        '''Iterate over OCR full text in chunks, e.g. for a streaming
+        response.  By default, full text is returned as a single chunk;
+        version-specific subclasses may return smaller chunks.'''
+        text = self.get_fulltext()
+        if text:
+            yield text
+
     def index_data(self):
         '''Extend the default
         :meth:`eulfedora.models.DigitalObject.index_data`
@@ -867,9 +889,10 @@ class Volume(DigitalObject, BaseVolume):
                        .filter(content_model=Page.PAGE_CMODEL_PATTERN) \
                        .filter(state='A') \
                        .sort_by('page_order') \
-                       .field_limit(['pid', 'page_order']) \
+                       .field_limit(['pid', 'page_order', 'page_width',
+                                     'page_height']) \
                        .results_as(SolrPage)
-        # only return fields we actually need (pid, page_order)
+        # only return fields we actually need (pid, page_order, dimensions)
         # TODO: add volume id for generating urls ?
         # solrquery = solrquery.field_limit(['pid', 'page_order', 'isConstituentOf'])  # ??
         # return so it can be filtered, paginated as needed
@@ -1159,9 +1182,20 @@ class VolumeV1_1(Volume):
 
     def get_fulltext(self):
         '''Return OCR full text (if available)'''
+        return ''.join(self.iter_fulltext())
+
+    def iter_fulltext(self):
+        '''Iterate over OCR full text one page at a time, with pages
+        separated by blank lines.'''
         q = self.find_solr_pages()
         q = q.field_limit(['page_text'])
-        return '\n\n'.join(p['page_text'] for p in q if 'page_text' in p)
+        first = True
+        for p in q:
+            if 'page_text' in p:
+                if not first:
+                    yield '\n\n'
+                yield p['page_text']
+                first = False
 
 class SolrVolume(UserDict, BaseVolume):
     '''Extension of :class:`~UserDict.UserDict` for use with Solr results
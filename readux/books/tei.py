@@ -269,6 +269,9 @@ class AnnotatedFacsimile(Facsimile):
 
     # additional mappings for annotation data
 
+    #: div containing annotations, at body/div[@type="annotations"]
+    annotation_div = xmlmap.NodeField('tei:text/tei:body/tei:div[@type="annotations"]',
+        xmlmap.XmlObject)
     #: list of annotations at body/div[@type="annotations"]/note[@type="annotation"], as :class:`Note`
     annotations = xmlmap.NodeListField('tei:text/tei:body/tei:div[@type="annotations"]/tei:note[@type="annotation"]',
         Note)
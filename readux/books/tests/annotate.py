@@ -11,8 +11,10 @@ from readux import __version__
 from readux.annotations.models import Annotation
 from readux.books import tei
 from readux.books.annotate import annotation_to_tei, insert_anchor, \
-    annotated_tei, consolidate_bibliography
+    annotated_tei, consolidate_bibliography, html_xpath_to_tei, \
+    annotation_url_format
 from readux.books.tests.models import FIXTURE_DIR
+from readux.utils import absolutize_url
 
 
 class AnnotatedTei(TestCase):
@@ -29,6 +31,10 @@ class AnnotatedTei(TestCase):
         self.assert_(isinstance(teinote, tei.Note))
         self.assertEqual('annotation-%s' % note.id, teinote.id)
         self.assert_(teinote.href.endswith(note.get_absolute_url()))
+        # url format should generate the same url
+        teinote = annotation_to_tei(note, teidoc,
+                                    url_format=annotation_url_format())
+        self.assertEqual(absolutize_url(note.get_absolute_url()), teinote.href)
         self.assertEqual(note.text, teinote.paragraphs[0])
 
         # todo: add a schema validation once we get the output to be valid
@@ -135,6 +141,23 @@ la la la foo bar lala
         # 0 index, anchor should be after tag
         self.assertEqual('anchor', element.getnext().tag)
 
+        # element with no text content
+        div = etree.fromstring('<div><p/></div>')
+        element = div.xpath('//p')[0]
+        anchor = etree.fromstring('<anchor/>')
+        insert_anchor(element, anchor, 3)
+        # anchor should be after tag
+        self.assertEqual('anchor', element.getnext().tag)
+
+    def test_html_xpath_to_tei(self):
+        self.assertEqual('//tei:zone[@xml:id="fnstr.idm320760248608"]/' +
+                         'node()[local-name()="line" or local-name()="w"][1]',
+            html_xpath_to_tei('//div[@id="fnstr.idm320760248608"]/span[1]'))
+        # repeated conversion should return the same result
+        self.assertEqual('//tei:zone[1]', html_xpath_to_tei('//div[1]'))
+        self.assertEqual('//tei:zone[1]', html_xpath_to_tei('//div[1]'))
+        self.assertEqual('', html_xpath_to_tei(''))
+
     def test_annotated_tei(self):
         # create annotation with a user
         user = get_user_model()(username='an_annotator',
@@ -171,6 +194,15 @@ la la la foo bar lala
                 })
             )
         imagenote.save()
+        # note on a different page that references this one as a related
+        # page; should not be added to this page
+        othernote = Annotation(text='see also', uri='http://readux.co/books/pages/some:2/',
+            extra_data=json.dumps({
+                'related_pages': [page_uri],
+                'ark': 'http://testpid.co/ark:/1234/22'
+                })
+            )
+        othernote.save()
 
         # use page tei fixture as starting point
         title = 'Lecoq'
@@ -213,6 +245,9 @@ la la la foo bar lala
         self.assert_(annotei.node.xpath('//tei:zone[@xml:id="highlight-%s"][@type="image-annotation-highlight"]' % imagenote.id,
             namespaces=tei.Zone.ROOT_NAMESPACES))
 
+        # note for another page should not be included
+        self.assertEqual(2, len(annotei.annotations))
+
         # tags added to back as interp group
         self.assertEqual('test', annotei.tags.interp[0].id)
         self.assertEqual('test', annotei.tags.interp[0].value)
@@ -220,6 +255,39 @@ la la la foo bar lala
         # encoding desc should be present
         self.assert_(annotei.encoding_desc)
 
+        # no annotations - header should still be updated
+        teidoc = load_xmlobject_from_file(os.path.join(FIXTURE_DIR, 'teifacsimile.xml'),
+            tei.AnnotatedFacsimile)
+        teidoc.title = title
+        annotei = annotated_tei(teidoc, Annotation.objects.none())
+        self.assertEqual(title, annotei.main_title)
+        self.assertEqual('annotated by', annotei.responsibility)
+        self.assertEqual(today, annotei.pubstmt.date)
+        self.assertEqual(0, len(annotei.annotations))
+        self.assertEqual(None, annotei.tags)
+
+        # annotation that can't be placed on the page should be skipped,
+        # without adding an empty annotations div
+        teidoc = load_xmlobject_from_file(os.path.join(FIXTURE_DIR, 'teifacsimile.xml'),
+            tei.AnnotatedFacsimile)
+        teidoc.page.href = page_uri
+        Annotation.objects.all().delete()
+        badnote = Annotation(text='misplaced', uri=page_uri, user=user,
+            extra_data=json.dumps({
+                'ranges': [
+                    {'start': '//div[@id="not-a-zone"]/span[1]',
+                     'end': '//div[@id="not-a-zone"]/span[1]',
+                     'startOffset': 0,
+                     'endOffset': 6
+                     }
+                ],
+                'ark': page_uri
+                }))
+        badnote.save()
+        annotei = annotated_tei(teidoc, Annotation.objects.all())
+        self.assertEqual(0, len(annotei.annotations))
+        self.assertEqual(None, annotei.annotation_div)
+
     def test_consolidate_bibl(self):
         teidoc = load_xmlobject_from_file(os.path.join(FIXTURE_DIR,
                                                        'teifacsimile.xml'),
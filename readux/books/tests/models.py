@@ -7,6 +7,7 @@ from django.test import TestCase
 from mock import patch, Mock
 import re
 import rdflib
+import requests
 from rdflib import RDF
 from urllib import urlencode, unquote
 
@@ -17,7 +18,7 @@ from piffle import iiif
 from readux.annotations.models import Annotation
 from readux.books import abbyyocr
 from readux.books.models import SolrVolume, Volume, VolumeV1_0, Book, BIBO, \
-    DC, Page, PageV1_1
+    DC, Image, Page, PageV1_1
 
 
 
@@ -411,6 +412,36 @@ class VolumeV1_0Test(TestCase):
             self.vol.add_ocr_ids()
             self.assertTrue(self.vol.ocr_has_ids)
 
+class PageTest(TestCase):
+
+    def test_index_data(self):
+        page = PageV1_1(Mock()) # use mock for fedora api, since we won't make any calls
+        page.pid = 'rdxtest:4607'
+
+        with patch.object(Image, 'index_data', return_value={}), \
+          patch.object(PageV1_1, 'page_order', new=3), \
+          patch.object(PageV1_1, 'image_metadata',
+                       new={'width': '1200', 'height': '1600'}), \
+          patch.object(page, 'has_fulltext', return_value=False):
+            data = page.index_data()
+            self.assertEqual(3, data['page_order'])
+            self.assertEqual(1200, data['page_width'],
+                'page width should be indexed from image metadata')
+            self.assertEqual(1600, data['page_height'],
+                'page height should be indexed from image metadata')
+
+        # image service unavailable; dimensions should be skipped
+        with patch.object(Image, 'index_data', return_value={}), \
+          patch.object(PageV1_1, 'page_order', new=3), \
+          patch('readux.books.models.requests.get',
+                side_effect=requests.exceptions.ConnectionError), \
+          patch.object(page, 'has_fulltext', return_value=False):
+            data = page.index_data()
+            self.assertEqual(3, data['page_order'])
+            self.assert_('page_width' not in data)
+            self.assert_('page_height' not in data)
+
+
 class PageV1_1Test(TestCase):
     metsalto_doc = os.path.join(FIXTURE_DIR, 'mets_alto.xml')
 
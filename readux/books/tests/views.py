@@ -1,5 +1,6 @@
 from datetime import datetime, timedelta
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
 from django.core.paginator import Paginator
 from django.core.urlresolvers import reverse
 from django.http import HttpResponse
@@ -11,7 +12,8 @@ from mock import Mock, patch, NonCallableMock, NonCallableMagicMock, \
 from urllib import unquote
 
 from readux.annotations.models import Annotation
-from readux.books.models import SolrVolume, Volume, Page, SolrPage
+from readux.books.models import SolrVolume, Volume, Page, SolrPage, \
+    IIIFImage
 from readux.books import sitemaps, views, view_helpers, forms
 from readux.utils import absolutize_url
 
@@ -42,9 +44,13 @@ class BookViewsTest(TestCase):
 <dsChecksum>cc0db0ef0fcd559065a788a22442d3c7</dsChecksum>
 </datastreamProfile>'''
 
+    @patch('readux.books.views.solr_interface')
     @patch('readux.books.views.VolumePdf.repository_class')
     @patch('eulfedora.views._raw_datastream')
-    def test_pdf(self, mockraw_ds, mockrepo_class):
+    def test_pdf(self, mockraw_ds, mockrepo_class, mocksolr_interface):
+        # label not indexed in solr; falls back to fedora
+        mocksolr = mocksolr_interface.return_value
+        mocksolr.query.return_value.field_limit.return_value = []
         mockobj = Mock()
         mockobj.pid = 'vol:1'
         mockobj.label = 'ocm30452349_1908'
@@ -99,10 +105,23 @@ class BookViewsTest(TestCase):
             'expected %s for %s when there is a fedora error, got %s' % \
             (expected, pdf_url, got))
 
+        # label indexed in solr
+        mockobj.exists = True
+        mocksolr.query.return_value.field_limit.return_value = [
+            {'label': 'ocm30452349_1908 V0.2'}]
+        response = self.client.get(pdf_url, {'download': 1})
+        mocksolr.query.assert_called_with(pid=mockobj.pid)
+        args, kwargs = mockraw_ds.call_args
+        self.assertEqual('attachment; filename="ocm30452349_1908-V0.2.pdf"',
+            kwargs['headers']['Content-Disposition'],
+            'content disposition filename should use label from solr')
+
     @patch('readux.books.views.Paginator', spec=Paginator)
     @patch('readux.books.views.solr_interface')
     @patch('readux.books.views.VolumeSearch.paginate_queryset')
     def test_search(self, mockqs_paginate, mocksolr_interface, mockpaginator):
+        # search facets are cached; start with an empty cache
+        cache.clear()
         mockpage = NonCallableMock()
         search_url = reverse('books:search')
 
@@ -147,6 +166,7 @@ class BookViewsTest(TestCase):
         results.facet_counts.facet_fields = {
             'collection_label_facet': [('Emory Yearbooks', 1), ('Yellowbacks', 4)]
         }
+        results.facet_counts.facet_queries = [('page_count:[2 TO *]', 1)]
         results.__len__.return_value = 2
 
         mockpage.object_list = results
@@ -201,6 +221,15 @@ class BookViewsTest(TestCase):
                 '?keyword=yellowbacks&amp;collection=%s' % coll.replace(' ', '%20'),
                 msg_prefix='response should include link to search filtered by collection facet')
 
+        # facets should be cached for the same search, regardless of sort
+        mocksolr.query.facet_by.reset_mock()
+        response = self.client.get(search_url, {'keyword': 'yellowbacks',
+                                                'sort': 'title'})
+        mocksolr.query.facet_by.assert_not_called()
+        for coll, count in results.facet_counts.facet_fields['collection_label_facet']:
+            self.assertContains(response, coll,
+                msg_prefix='cached collection facet should be displayed')
+
         # multiple terms and phrase
         response = self.client.get(search_url, {'keyword': 'yellowbacks "lecoq the detective" mystery'})
         for term in ['yellowbacks', 'lecoq the detective', 'mystery']:
@@ -238,14 +267,15 @@ class BookViewsTest(TestCase):
         mockrepo.api.getDatastream.return_value.content = self.xml_profile
         mockrepo.api.getDatastream.return_value.url = 'http://fedora.co/objects/ds'
 
-        mockobj.get_fulltext.return_value = 'sample text content'
+        mockobj.iter_fulltext.return_value = iter(['sample text ', 'content'])
         # to support for last modified conditional
         mockobj.ocr.created = datetime.now()
 
         text_url = reverse('books:text', kwargs={'pid': mockobj.pid})
         response = self.client.get(text_url)
 
-        self.assertEqual(mockobj.get_fulltext.return_value, response.content,
+        self.assertEqual('sample text content',
+            ''.join(response.streaming_content),
             'volume full text should be returned as response content')
         self.assertEqual(response['Content-Type'], "text/plain")
         self.assertEqual(response['Content-Disposition'],
@@ -306,6 +336,8 @@ class BookViewsTest(TestCase):
             self.assertContains(response, '<format name="%s" type="%s"' \
                 % (fmt_name, fmt_info['type']),
                 msg_prefix='formats should include %s' % fmt_name)
+        # object not needed to list formats
+        mockrepo.return_value.get_object.assert_not_called()
 
         # request with id and format
         response = self.client.get(unapi_url, {'id': mockobj.pid, 'format': 'rdf_dc'})
@@ -415,10 +447,28 @@ class BookViewsTest(TestCase):
             (expected, vol_url, got))
 
 
+    def test_counted_solr_query(self):
+        mockquery = MagicMock()
+        mockquery.count.return_value = 12
+        counted_query = views.CountedSolrQuery(mockquery)
+        self.assertEqual(12, counted_query.count())
+        self.assertEqual(12, len(counted_query))
+        # count should only be retrieved from solr once
+        mockquery.count.assert_called_once_with()
+        # slicing passed through to the query
+        counted_query[0:5]
+        mockquery.__getitem__.assert_called_with(slice(0, 5))
+
+        # known total should be used without querying solr
+        mockquery.reset_mock()
+        counted_query = views.CountedSolrQuery(mockquery, 3)
+        self.assertEqual(3, counted_query.count())
+        self.assertEqual(3, len(counted_query))
+        mockquery.count.assert_not_called()
+
     @patch('readux.books.views.Repository')
-    @patch('readux.books.views.Paginator', spec=Paginator)
     @patch('readux.books.views.solr_interface')
-    def test_volume_page_search(self, mocksolr_interface, mockpaginator, mockrepo):
+    def test_volume_page_search(self, mocksolr_interface, mockrepo):
         mockobj = NonCallableMock()
         mockobj.pid = 'vol:1'
         mockobj.title = 'Lecoq, the detective'
@@ -448,15 +498,13 @@ class BookViewsTest(TestCase):
         mocksolr.query.__iter__.return_value = iter(solr_result)
         mocksolr.count.return_value = 2
 
-        mockpage = NonCallableMock()
-        mockpaginator.return_value.page.return_value = mockpage
-        results = NonCallableMagicMock(spec=['__iter__', 'facet_counts', 'highlighting'])
+        # page of results and total count retrieved in a single query
+        results = NonCallableMagicMock(spec=['__iter__', '__len__',
+            'facet_counts', 'highlighting', 'result'])
         results.__iter__.return_value = iter(solr_result)
-
-        mockpage.object_list = results
-        mockpage.has_other_pages = False
-        mockpage.paginator.count = 2
-        mockpage.paginator.page_range = [1]
+        results.__len__.return_value = 2
+        results.result.numFound = 2
+        mocksolr.query.execute.return_value = results
          # patch in highlighting - apparent change in sunburnt behavior
         results.highlighting = {
             'page:1': {'page_text': ['snippet with search term']},
@@ -468,6 +516,10 @@ class BookViewsTest(TestCase):
         self.assertEqual(response.templates[0].name,
             views.VolumeDetail.search_template_name,
             'volume search template should be used for valid search submission')
+        mocksolr.query.paginate.assert_called_with(start=0, rows=30)
+        self.assertEqual(2, response.context['paginator'].count,
+            'total from solr response should be used for paginator count')
+        mocksolr.query.count.assert_not_called()
         for page in iter(solr_result):
             self.assertContains(response,
                 reverse('books:page-image', kwargs={'vol_pid': mockobj.pid,
@@ -521,6 +573,8 @@ class BookViewsTest(TestCase):
     # @patch('readux.books.views.solr_interface')
     # def test_volume_pages(self, mocksolr_interface, mockpaginator, mockrepo):
     def test_volume_pages(self, mockpaginator, mockrepo):
+        # annotation counts are cached; start with an empty cache
+        cache.clear()
         mockvol = NonCallableMock(spec=Volume)
         mockvol.pid = 'vol:1'
         mockvol.title = 'Lecoq, the detective'
@@ -532,9 +586,11 @@ class BookViewsTest(TestCase):
         mockvol.get_absolute_url.return_value = reverse('books:volume',
             kwargs={'pid': mockvol.pid})
         mockrepo.return_value.get_object.return_value = mockvol
+        # solr results without page dimensions
         mockvol.find_solr_pages = MagicMock()
-        mockvol.find_solr_pages.return_value.count = 3
-        mockvol.find_solr_pages.__len__.return_value = 3
+        mockvol.find_solr_pages.return_value = [
+            SolrPage(pid='page:1', page_order=1)
+        ]
         mockpage = Mock(width=640, height=400)
         mockvol.pages = [mockpage]
 
@@ -546,6 +602,9 @@ class BookViewsTest(TestCase):
         self.assert_(mockvol, response.context['vol'])
         # annotated pages should be empty for anonymous user
         self.assertEqual({}, response.context['annotated_pages'])
+        # layout from first volume page loaded from fedora,
+        # since dimensions are not available in solr
+        self.assertEqual('landscape', response.context['layout'])
 
         # log in as a regular user
         self.client.login(**self.user_credentials['user'])
@@ -568,6 +627,48 @@ class BookViewsTest(TestCase):
         self.assertEqual(2, annotated_pages[absolutize_url(page2_url)])
         self.assertEqual(13, annotated_pages[page3_url])
 
+        # page dimensions indexed in solr; pages should not be loaded
+        # from fedora to determine layout
+        mockvol.pages = []
+        mockvol.find_solr_pages.return_value = [
+            SolrPage(pid='page:1', page_order=1, page_width=400,
+                     page_height=640),
+            SolrPage(pid='page:2', page_order=2, page_width=700,
+                     page_height=640),
+        ]
+        response = self.client.get(vol_page_url)
+        self.assertEqual('default', response.context['layout'])
+
+    @patch('readux.books.views.requests')
+    @patch('readux.books.views.TypeInferringRepository')
+    def test_page_image(self, mockrepo, mockrequests):
+        mockresponse = mockrequests.get.return_value
+        mockresponse.status_code = 200
+        mockresponse.headers = {'Content-Type': 'image/jpeg'}
+        mockresponse.content = 'image data'
+
+        # full size image url is based on the pid only;
+        # page should not be loaded from fedora
+        img_url = reverse('books:page-image',
+            kwargs={'vol_pid': 'vol:1', 'pid': 'page:1', 'mode': 'fs'})
+        response = self.client.get(img_url)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('image data', response.content)
+        self.assertEqual(unicode(IIIFImage(pid='page:1')),
+                         unicode(mockrequests.get.call_args[0][0]))
+        mockrepo.return_value.get_object.assert_not_called()
+
+        # thumbnail is sized based on image dimensions;
+        # page should be loaded from fedora
+        mockpage = mockrepo.return_value.get_object.return_value
+        mockpage.iiif.thumbnail.return_value = 'http://img.co/thumb.jpg'
+        img_url = reverse('books:page-image',
+            kwargs={'vol_pid': 'vol:1', 'pid': 'page:1', 'mode': 'thumbnail'})
+        response = self.client.get(img_url)
+        mockrepo.return_value.get_object.assert_called_with('page:1', type=Page)
+        mockrequests.get.assert_called_with('http://img.co/thumb.jpg',
+                                            headers={})
+
     @patch('readux.books.views.TypeInferringRepository')
     def test_view_page(self, mockrepo):
         mockobj = Mock()
@@ -605,14 +706,11 @@ class BookViewsTest(TestCase):
         nearby_pages = [
             {'pid': 'page:4', 'page_order': '4'},
             {'pid': 'page:5', 'page_order': '5'},
-            {'pid': 'page:5', 'page_order': '6'},
+            {'pid': 'page:6', 'page_order': '6'},
         ]
         solr_result.__iter__.return_value = nearby_pages
         mocksolr_query = MagicMock()
         mocksolr_query.__iter__.return_value = iter(solr_result)
-        mocksolr_query.__len__.return_value = 3
-        # cheating here, since we know what index should be requested...
-        mocksolr_query.__getitem__.return_value = nearby_pages[2]
         mocksolr_query.query.return_value = mocksolr_query
         mockobj.volume.find_solr_pages.return_value = mocksolr_query
         mockrepo.return_value.get_object.return_value = mockobj
@@ -625,6 +723,7 @@ class BookViewsTest(TestCase):
             'previous page should be selected from solr result and set in context')
         self.assertEqual(nearby_pages[2], response.context['next'],
             'next page should be selected from solr result and set in context')
+        mocksolr_query.query.assert_called_with(page_order__range=(3, 7))
         self.assertEqual(1, response.context['page_chunk'],
             'chunk of paginated pages should be calculated and set in context')
         self.assertNotContains(response,
@@ -632,6 +731,17 @@ class BookViewsTest(TestCase):
                 kwargs={'vol_pid': mockobj.volume.pid, 'pid': mockobj.pid}),
             msg_prefix='page without tei should NOT link to tei in header')
 
+        # gaps in page order; nearest pages should be used
+        gap_pages = [
+            {'pid': 'page:3', 'page_order': '3'},
+            {'pid': 'page:5', 'page_order': '5'},
+            {'pid': 'page:7', 'page_order': '7'},
+        ]
+        mocksolr_query.__iter__.return_value = iter(gap_pages)
+        response = self.client.get(url)
+        self.assertEqual(gap_pages[0], response.context['prev'])
+        self.assertEqual(gap_pages[2], response.context['next'])
+
         # TODO:
         # - test metadata in header (twitter/og fields)
         # - test page image, deep zoom content, title display, etc
@@ -695,8 +805,14 @@ class BookViewsTest(TestCase):
             Page.tei.id, asOfDateTime=None, rqst_headers={}, stream=True)
 
 
+    @patch('readux.books.views.solr_interface')
     @patch('readux.books.views.TypeInferringRepository')
-    def test_page_redirect(self, mockrepo):
+    def test_page_redirect(self, mockrepo, mocksolr_interface):
+        mocksolr = mocksolr_interface.return_value
+        mockpagequery = mocksolr.query.return_value.filter.return_value \
+                                .field_limit.return_value
+        # not found in solr; falls back to fedora
+        mockpagequery.__iter__.return_value = []
         mockobj = Mock()
         mockobj.pid = 'page:1'
         mockobj.volume.pid = 'vol:1'
@@ -755,6 +871,22 @@ class BookViewsTest(TestCase):
             reverse('books:page-ocr', **url_args),
             response['location'])
 
+        # volume found in solr; fedora should not be used
+        mockrepo.reset_mock()
+        mockpagequery.__iter__.return_value = [
+            {'pid': 'page:5', 'isConstituentOf': ['info:fedora/vol:1']}
+        ]
+        url = reverse('books:old-pageurl-redirect',
+            kwargs={'pid': mockobj.pid, 'path': ''})
+        response = self.client.get(url, follow=False)
+        self.assertEqual(301, response.status_code,
+            'page redirect view should return a permanent redirect')
+        self.assertEqual('http://testserver%s' % \
+            reverse('books:page', **url_args),
+            response['location'])
+        mocksolr.query.assert_called_with(pid=mockobj.pid)
+        mockrepo.return_value.get_object.assert_not_called()
+
     @patch('readux.books.sitemaps.solr_interface')
     def test_sitemaps(self, mocksolr_interface):
         # minimal test, just to check that sitemaps render without error
@@ -809,16 +941,17 @@ class ViewHelpersTest(TestCase):
         # no solr results
         mockresult = MagicMock()
         mocksolr_interface.return_value.query.return_value.sort_by.return_value.field_limit.return_value = mockresult
-        mockresult.count.return_value = 0
+        mockresult.paginate.return_value = []
         lastmod = view_helpers.volume_pages_modified(mockrequest, 'vol:1')
         self.assertEqual(None, lastmod)
 
         # only solr result
-        mockresult.count.return_value = 1
         yesterday = datetime.now() - timedelta(days=1)
-        mockresult.__getitem__.return_value = {'timestamp': yesterday}
+        mockresult.paginate.return_value = [{'timestamp': yesterday}]
         lastmod = view_helpers.volume_pages_modified(mockrequest, 'vol:1')
         self.assertEqual(yesterday, lastmod)
+        # only the first result should be requested
+        mockresult.paginate.assert_called_with(rows=1)
 
         # test with both solr and annotations for logged in user
         mockvol.get_absolute_url.return_value = reverse('books:volume', kwargs={'pid': mockvol.pid})
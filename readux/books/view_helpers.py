@@ -38,7 +38,7 @@ def volumes_modified(request, *args, **kwargs):
         latest_note = Annotation.objects.visible_to(request.user) \
                                 .last_created_time()
 
-    solrtime = results[0]['timestamp'] if results.count() else None
+    solrtime = latest_solr_timestamp(results)
     return solrtimestamp_or_datetime(solrtime, latest_note)
 
 
@@ -65,7 +65,7 @@ def volume_modified(request, pid):
         latest_note = vol.annotations().visible_to(request.user) \
                          .last_created_time()
 
-    solrtime = results[0]['timestamp'] if results.count() else None
+    solrtime = latest_solr_timestamp(results)
     return solrtimestamp_or_datetime(solrtime, latest_note)
 
 
@@ -105,7 +105,7 @@ def volume_pages_modified(request, pid):
             # no notes for this volume
             pass
 
-    solrtime = results[0]['timestamp'] if results.count() else None
+    solrtime = latest_solr_timestamp(results)
     return solrtimestamp_or_datetime(solrtime, latest_note)
 
 
@@ -127,10 +127,19 @@ def page_modified(request, vol_pid, pid):
         latest_note = page.annotations().visible_to(request.user) \
                           .last_updated_time()
 
-    solrtime = results[0]['timestamp'] if results.count() else None
+    solrtime = latest_solr_timestamp(results)
     return solrtimestamp_or_datetime(solrtime, latest_note)
 
 
+def latest_solr_timestamp(results):
+    '''Timestamp from the first result of a solr query sorted by
+    timestamp, or None if there are no results.  Only the first row is
+    requested, in a single query (checking the count and then indexing
+    the sunburnt query would result in two solr requests).'''
+    for result in results.paginate(rows=1):
+        return result['timestamp']
+
+
 def solrtimestamp_or_datetime(solrtime, othertime):
     # Compare and return the more recent of a solr timestamp or an
     # annotation datetime.
@@ -1,6 +1,8 @@
 from channels import Channel
 from django.conf import settings
-from django.core.paginator import Paginator, EmptyPage, InvalidPage
+from django.core.cache import cache
+from django.core.paginator import Paginator, EmptyPage, InvalidPage, \
+    Page as PaginatorPage
 from django.core.urlresolvers import reverse
 from wsgiref.util import FileWrapper
 from django.contrib.sites.shortcuts import get_current_site
@@ -17,8 +19,10 @@ from django.views.generic import ListView, DetailView, View
 from django.views.generic.edit import FormMixin, ProcessFormView
 from django.views.generic.base import RedirectView
 from eulcommon.djangoextras.auth import login_required_with_ajax
+import hashlib
 import json
 from urllib import urlencode
+import operator
 import os
 import re
 import requests
@@ -28,9 +32,9 @@ from eulfedora.server import Repository, TypeInferringRepository
 from eulfedora.util import RequestFailed
 from eulfedora.views import raw_datastream, RawDatastreamView
 
-from readux.annotations.models import AnnotationGroup
+from readux.annotations.models import Annotation, AnnotationGroup
 from readux.books.models import Volume, SolrVolume, Page, VolumeV1_0, \
-    PageV1_1, SolrPage
+    PageV1_1, SolrPage, IIIFImage
 from readux.books.forms import BookSearch, VolumeExport
 from readux.books import view_helpers, annotate, export, github
 from readux.utils import solr_interface, absolutize_url
@@ -39,6 +43,82 @@ from readux.views import VaryOnCookieMixin
 
 logger = logging.getLogger(__name__)
 
+#: timeout for cached annotation counts, in seconds
+ANNOTATION_COUNT_CACHE_TIMEOUT = 60
+
+# unbound search form for display on volume and page views; unbound
+# forms hold no request data, so a single instance can be shared
+_empty_book_search = BookSearch()
+
+
+def _annotation_count_cache_key(prefix, user):
+    '''Cache key for annotation counts for a user; includes the user's
+    annotation count version, so that counts are updated as soon as
+    the user adds or removes an annotation.'''
+    return '%s-%s-%s' % (prefix, user.pk, Annotation.count_version(user))
+
+
+def _local_annotation_counts(request, cache_key, get_counts):
+    '''Annotation counts keyed on local url, for easy lookup in templates.
+    Counts are cached, since they are displayed on frequently
+    viewed pages.
+
+    :param request: current request, used to determine the site domain
+    :param cache_key: key for caching the counts
+    :param get_counts: function that returns a dictionary of
+        annotation counts keyed on absolute url
+    '''
+    annotation_counts = cache.get(cache_key)
+    if annotation_counts is None:
+        # strip out base site url for easy lookup in the template
+        # (need leading / left to match item urls)
+        domain = get_current_site(request).domain.rstrip('/')
+        if not domain.startswith('https'):
+            domain = 'https://' + domain
+        prefix_len = len(domain)
+        annotation_counts = {
+            (k[prefix_len:] if k.startswith(domain) else k): v
+            for k, v in get_counts().iteritems()}
+        cache.set(cache_key, annotation_counts,
+                  ANNOTATION_COUNT_CACHE_TIMEOUT)
+    return annotation_counts
+
+
+def _search_cache_key(prefix, params, exclude):
+    '''Cache key for a search, based on a hash of the request
+    parameters, ignoring any that don't change the search results
+    (e.g., sort or page).'''
+    params = sorted((key.encode('utf-8'), value.encode('utf-8'))
+                    for key, values in params.lists()
+                    for value in values
+                    if key not in exclude)
+    return '%s-%s' % (prefix, hashlib.md5(urlencode(params)).hexdigest())
+
+
+class CountedSolrQuery(object):
+    '''Wrapper for a sunburnt solr query, for use with the django
+    :class:`~django.core.paginator.Paginator`.  If the total result
+    count is already known (e.g., from a paginated solr response),
+    it is used instead of making a separate count query.
+
+    :param query: sunburnt solr query
+    :param total: total result count, if known
+    '''
+
+    def __init__(self, query, total=None):
+        self.query = query
+        self.total = total
+
+    def count(self):
+        if self.total is None:
+            self.total = self.query.count()
+        return self.total
+
+    __len__ = count
+
+    def __getitem__(self, k):
+        return self.query[k]
+
 
 class VolumeSearch(ListView):
     '''Search across all volumes.'''
@@ -51,11 +131,21 @@ class VolumeSearch(ListView):
     display_mode = 'list'
     display_filters = []
     sort_options = ['relevance', 'title', 'date added']
+    #: facets for the current search, if found in the cache
+    facets = None
+    #: timeout for cached facet counts, in seconds
+    facet_cache_timeout = 60 * 5
 
     @method_decorator(last_modified(view_helpers.volumes_modified))
     def dispatch(self, *args, **kwargs):
         return super(VolumeSearch, self).dispatch(*args, **kwargs)
 
+    def facet_cache_key(self):
+        '''Cache key for facets of the current search; based on
+        search terms and filters, ignoring sort and page.'''
+        return _search_cache_key('volume-search-facets', self.request.GET,
+                                 ['sort', 'page'])
+
     def get_queryset(self):
         self.form = BookSearch(self.request.GET)
 
@@ -67,13 +157,12 @@ class VolumeSearch(ListView):
             terms = self.form.search_terms()
             solr = solr_interface()
             # generate queries text and boost-field queries
-            text_query = solr.Q()
-            author_query = solr.Q()
-            title_query = solr.Q()
-            for t in terms:
-                text_query |= solr.Q(t)
-                author_query |= solr.Q(creator=t)
-                title_query |= solr.Q(title=t)
+            text_query = reduce(operator.or_, [solr.Q(t) for t in terms],
+                                solr.Q())
+            author_query = reduce(operator.or_,
+                                  [solr.Q(creator=t) for t in terms], solr.Q())
+            title_query = reduce(operator.or_,
+                                 [solr.Q(title=t) for t in terms], solr.Q())
 
             q = solr.query().filter(content_model=Volume.VOLUME_CMODEL_PATTERN) \
                     .query(text_query | author_query**3 | title_query**3) \
@@ -92,10 +181,12 @@ class VolumeSearch(ListView):
             elif self.sort == 'date added':
                 q = q.sort_by('-created')
 
-            url_params = self.request.GET.copy()
+            # facet counts change infrequently, so they are cached for
+            # each search; if cached, don't facet the solr query
+            self.facets = cache.get(self.facet_cache_key())
 
             # don't need to facet on collection if we are already filtered on collection
-            if 'collection' not in self.request.GET:
+            if self.facets is None and 'collection' not in self.request.GET:
                 q = q.facet_by('collection_label_facet', sort='index', mincount=1)
 
             self.display_filters = []
@@ -104,7 +195,7 @@ class VolumeSearch(ListView):
                 # filter the solr query based on the requested collection
                 q = q.query(collection_label='"%s"' % filter_val)
                 # generate link to remove the facet
-                unfacet_urlopts = url_params.copy()
+                unfacet_urlopts = self.request.GET.copy()
                 del unfacet_urlopts['collection']
                 self.display_filters.append(('collection', filter_val,
                                         unfacet_urlopts.urlencode()))
@@ -112,11 +203,11 @@ class VolumeSearch(ListView):
             # active filter - only show volumes with pages loaded
             if 'read_online' in self.request.GET and self.request.GET['read_online']:
                 q = q.query(page_count__gte=2)
-                unfacet_urlopts = url_params.copy()
+                unfacet_urlopts = self.request.GET.copy()
                 del unfacet_urlopts['read_online']
                 self.display_filters.append(('Read online', '',
                                         unfacet_urlopts.urlencode()))
-            else:
+            elif self.facets is None:
                 # generate a facet count for books with pages loaded
                 q = q.facet_query(page_count__gte=2)
 
@@ -130,49 +221,57 @@ class VolumeSearch(ListView):
     def get_context_data(self):
         context_data = super(VolumeSearch, self).get_context_data()
 
-        url_params = self.request.GET.copy()
-        sort_url_params = self.request.GET.copy()
-        if 'sort' in sort_url_params:
+        # current url parameters, used for both pagination and mode links
+        url_params = urlencode(self.request.GET)
+        # only copy request parameters when sort needs to be removed
+        if 'sort' in self.request.GET:
+            sort_url_params = self.request.GET.copy()
             del sort_url_params['sort']
+            sort_url_params = urlencode(sort_url_params)
+        else:
+            sort_url_params = url_params
 
         context_data.update({
             'form': self.form,
-            'url_params': urlencode(url_params),
+            'url_params': url_params,
             'mode': self.display_mode,  # list / cover view
-            'current_url_params': urlencode(self.request.GET.copy()),
+            'current_url_params': url_params,
             'sort': self.sort,
             'sort_options': self.sort_options,
-            'sort_url_params': urlencode(sort_url_params),
+            'sort_url_params': sort_url_params,
         })
 
         # get facets and annotations IF there are are any search results
         if context_data['object_list']:
-            # adjust facets as returned from solr for display
-            facet_counts = context_data['object_list'].facet_counts
-            facets = {}
-            collections = facet_counts.facet_fields.get('collection_label_facet', [])
-            # only include collections in facet if there are any
-            if collections:
-                facets['collection'] = collections
-            if facet_counts.facet_queries:
-                # number of volumes with pages loaded;
-                # facet query is a list of tuple; second value is the count
-                pages_loaded = facet_counts.facet_queries[0][1]
-                # only display if it is a facet, i.e. not all volumes
-                # in the result set have pages loaded
-                if pages_loaded < context_data['paginator'].count:
-                    facets['pages_loaded'] = facet_counts.facet_queries[0][1]
-
-            # generate list for display and removal of active filters
-            q = self.get_queryset()
+            # total number of results, as already calculated by the paginator
+            total = context_data['paginator'].count
+            facets = self.facets
+            if facets is None:
+                # adjust facets as returned from solr for display
+                facet_counts = context_data['object_list'].facet_counts
+                facets = {}
+                collections = facet_counts.facet_fields.get('collection_label_facet', [])
+                # only include collections in facet if there are any
+                if collections:
+                    facets['collection'] = collections
+                if facet_counts.facet_queries:
+                    # number of volumes with pages loaded;
+                    # facet query is a list of tuple; second value is the count
+                    pages_loaded = facet_counts.facet_queries[0][1]
+                    # only display if it is a facet, i.e. not all volumes
+                    # in the result set have pages loaded
+                    if pages_loaded < total:
+                        facets['pages_loaded'] = pages_loaded
+                cache.set(self.facet_cache_key(), facets,
+                          self.facet_cache_timeout)
+
             annotated_volumes = {}
-            if context_data['paginator'].count and self.request.user.is_authenticated():
-                notes = Volume.volume_annotation_count(self.request.user)
-                domain = get_current_site(self.request).domain.rstrip('/')
-                if not domain.startswith('https'):
-                    domain = 'https://' + domain
-                annotated_volumes = dict([(k.replace(domain, ''), v)
-                                   for k, v in notes.iteritems()])
+            if total and self.request.user.is_authenticated():
+                user = self.request.user
+                cache_key = _annotation_count_cache_key(
+                    'volume-annotation-count', user)
+                annotated_volumes = _local_annotation_counts(self.request,
+                    cache_key, lambda: Volume.volume_annotation_count(user))
 
             context_data.update({
                 'facets': facets,  # available facets
@@ -249,15 +348,24 @@ class VolumeDetail(DetailView, VaryOnCookieMixin):
             # sort by relevance and then by page order
 
 
-            # paginate the solr result set
-            paginator = Paginator(q, 30)
+            # paginate the solr result set; the requested page of results
+            # and the total count are retrieved in a single solr query,
+            # and the total is passed to the paginator
+            per_page = 30
             try:
-                page = int(self.request.GET.get('page', '1'))
+                page = max(int(self.request.GET.get('page', '1')), 1)
             except ValueError:
                 page = 1
+            response = q.paginate(start=(page - 1) * per_page,
+                                  rows=per_page).execute()
+            paginator = Paginator(
+                CountedSolrQuery(q, response.result.numFound), per_page)
             try:
-                results = paginator.page(page)
+                results = PaginatorPage(response,
+                                        paginator.validate_number(page),
+                                        paginator)
             except (EmptyPage, InvalidPage):
+                # out of range; query for the last page of results
                 results = paginator.page(paginator.num_pages)
 
             # NOTE: highlight snippets are available at
@@ -345,21 +453,16 @@ class VolumePageList(ListView, VaryOnCookieMixin):
 
         context_data.update({
             'vol': self.vol,
-            'form': BookSearch(), # form for searching in this book
+            'form': _empty_book_search, # form for searching in this book
         })
 
         # if user is authenticated, check for annotations on this volume
         if self.request.user.is_authenticated():
-            notes = self.vol.page_annotation_count(self.request.user)
-            # method returns a dict for easy lookup;
-            # strip out base site url for easy lookup in the template
-            # (need leading / left to match item urls)
-            domain = get_current_site(self.request).domain.rstrip('/')
-            if not domain.startswith('https'):
-                domain = 'https://' + domain
-
-            annotated_pages = dict([(k.replace(domain, ''), v)
-                                   for k, v in notes.iteritems()])
+            user = self.request.user
+            cache_key = _annotation_count_cache_key(
+                'page-annotation-count-%s' % self.vol.pid, user)
+            annotated_pages = _local_annotation_counts(self.request,
+                cache_key, lambda: self.vol.page_annotation_count(user))
         else:
             annotated_pages = {}
         context_data.update({
@@ -368,9 +471,22 @@ class VolumePageList(ListView, VaryOnCookieMixin):
         })
 
         # Check if the first page of the volume is wider than it is tall
-        # to set the layout of the pages
-        first_page = self.vol.pages[0]
-        if first_page.width > first_page.height:
+        # to set the layout of the pages; use dimensions from solr
+        # when indexed, to avoid loading pages from fedora
+        # - on the first page of results, the first volume page has
+        #   already been retrieved; otherwise get it from solr
+        if context_data['page_obj'].number == 1:
+            first_pages = context_data['object_list'][:1]
+        else:
+            first_pages = self.object_list[:1]
+        width = height = None
+        if first_pages:
+            width = first_pages[0].get('page_width')
+            height = first_pages[0].get('page_height')
+        if width is None or height is None:
+            first_page = self.vol.pages[0]
+            width, height = first_page.width, first_page.height
+        if width > height:
             layout = 'landscape'
         else:
             layout = 'default'
@@ -403,29 +519,30 @@ class PageDetail(DetailView, VaryOnCookieMixin):
     def get_context_data(self, **kwargs):
         context_data = super(PageDetail, self).get_context_data()
         # use solr to find adjacent pages to this one
+        page_order = self.object.page_order
         pagequery = self.object.volume.find_solr_pages()
         # search range around current page order
         # (+/-1 should probably work, but using 2 to allow some margin for error)
-        pagequery = pagequery.query(page_order__range=(self.object.page_order - 2,
-                                                       self.object.page_order + 2))
+        pagequery = pagequery.query(page_order__range=(page_order - 2,
+                                                       page_order + 2))
 
-        # find the index of the current page in the sorted solr result
-        index = 0
+        # results are sorted by page order; skip the current page (by pid)
+        # and find the nearest pages before and after it
         prev = nxt = None
         for p in pagequery:
             if p['pid'] == self.object.pid:
-                break
-            index += 1
-            prev = p
-
-        if len(pagequery) > index + 1:
-            nxt = pagequery[index + 1]
+                continue
+            p_order = int(p['page_order'])
+            if p_order < page_order:
+                prev = p
+            elif p_order > page_order and nxt is None:
+                nxt = p
 
         # calculates which paginated page the page is part of based on 30 items per page
         page_chunk = ((self.object.page_order - 1) // 30) + 1
 
         # form for searching in this book
-        form = BookSearch()
+        form = _empty_book_search
 
         # currently only pagev1_1 has tei
         if hasattr(self.object, 'tei') and self.object.tei.exists:
@@ -527,17 +644,23 @@ class VolumePdf(VolumeDatastreamView):
         download = 'download' in self.request.GET
         # if download is requested, set content-disposition to prompt download
         attachment = 'attachment; ' if download else ''
-        # retrieve the object so we can use it to set the download filename
-        obj = self.get_repository().get_object(self.kwargs['pid'], type=self.object_type)
-        if not obj.exists:
-            raise Http404
+        # use the label indexed in solr to set the download filename,
+        # to avoid retrieving the object from fedora
+        solr = solr_interface()
+        q = solr.query(pid=self.kwargs['pid']).field_limit('label')
+        label = next(iter([result.get('label') for result in q]), None)
+        if not label:
+            # not indexed; retrieve the object to get the label
+            obj = self.get_repository().get_object(self.kwargs['pid'], type=self.object_type)
+            if not obj.exists:
+                raise Http404
+            label = obj.label
 
-        if obj.exists:  # assuming if exists passes we can get a label
-            return {
-                # generate a default filename based on the object label
-                'Content-Disposition': '%sfilename="%s.pdf"' % \
-                    (attachment, obj.label.replace(' ', '-'))
-                }
+        return {
+            # generate a default filename based on the object label
+            'Content-Disposition': '%sfilename="%s.pdf"' % \
+                (attachment, label.replace(' ', '-'))
+            }
 
 
 class VolumeOcr(VolumeDatastreamView):
@@ -564,7 +687,10 @@ class VolumeText(VolumeOcr):
         if not obj.exists or not obj.has_requisite_content_models or not obj.fulltext_available:
             raise Http404
 
-        response = HttpResponse(obj.get_fulltext(), 'text/plain')
+        # stream the text content, so the full text of large volumes
+        # doesn't need to be held in memory
+        response = StreamingHttpResponse(obj.iter_fulltext(),
+                                         content_type='text/plain')
         # generate a default filename based on the object label
         response['Content-Disposition'] = 'filename="%s.txt"' % \
             obj.label.replace(' ', '-')
@@ -693,18 +819,19 @@ class Unapi(View):
         fmt = request.GET.get('format', None)
         if item_id is not None:
             context['id'] = item_id
-            repo = Repository(request=self.request)
-            # generalized class-based view would need probably a get-item method
-            # for repo objects, could use type-inferring repo variant
-            obj = repo.get_object(item_id, type=Volume)
-
-            formats = obj.unapi_formats
+            # formats are defined on the class, so the object is only
+            # needed when a specific format is requested
+            formats = Volume.unapi_formats
 
             if fmt is None:
                 # display formats for this item
                 context['formats'] = formats
             else:
                 current_format = formats[fmt]
+                repo = Repository(request=self.request)
+                # generalized class-based view would need probably a get-item method
+                # for repo objects, could use type-inferring repo variant
+                obj = repo.get_object(item_id, type=Volume)
                 # return requested format for this item
                 meth = getattr(obj, current_format['method'])
                 return HttpResponse(meth(), content_type=current_format['type'])
@@ -720,25 +847,35 @@ class Unapi(View):
             content_type='application/xml')
 
 
+#: error images for 401/404/500 errors when serving out images from fedora
+ERROR_IMAGES = {
+    'thumbnail': 'notfound_thumbnail.png',
+    'single-page': 'notfound_page.png',
+    'mini-thumbnail': 'notfound_mini_thumbnail_page.png',
+}
 
-def _error_image_response(mode):
-    # error image http response for 401/404/500 errors when serving out
-    # images from fedora
-    error_images = {
-        'thumbnail': 'notfound_thumbnail.png',
-        'single-page': 'notfound_page.png',
-        'mini-thumbnail': 'notfound_mini_thumbnail_page.png',
-    }
-    # need a different way to catch it
-    if mode in error_images:
-        img = error_images[mode]
+# error image content, loaded from disk the first time it is needed
+_ERROR_IMAGE_CACHE = {}
 
+def _load_error_image(mode):
+    # return image content for the specified mode, reading it from
+    # static files on first use
+    if mode not in _ERROR_IMAGE_CACHE:
         if settings.DEBUG:
             base_path = settings.STATICFILES_DIRS[0]
         else:
             base_path = settings.STATIC_ROOT
-        with open(os.path.join(base_path, 'img', img)) as content:
-            return HttpResponseNotFound(content.read(), content_type='image/png')
+        with open(os.path.join(base_path, 'img', ERROR_IMAGES[mode]), 'rb') as content:
+            _ERROR_IMAGE_CACHE[mode] = content.read()
+    return _ERROR_IMAGE_CACHE[mode]
+
+def _error_image_response(mode):
+    # error image http response for 401/404/500 errors when serving out
+    # images from fedora
+    # need a different way to catch it
+    if mode in ERROR_IMAGES:
+        return HttpResponseNotFound(_load_error_image(mode),
+                                    content_type='image/png')
 
 
 class PageRedirect(RedirectView):
@@ -747,14 +884,30 @@ class PageRedirect(RedirectView):
     permanent = True
 
     def get_redirect_url(self, *args, **kwargs):
-        # NOTE: type inferring repository needed to load pages as correct type
-        # of Page (v1.0 or v1.1)
-        repo = TypeInferringRepository()
-        page = repo.get_object(kwargs['pid'])
-        if not page.exists or not isinstance(page, Page):
-            raise Http404
+        # find the volume the page belongs to in solr, to avoid
+        # loading both page and volume from fedora
+        solr = solr_interface()
+        pagequery = solr.query(pid=kwargs['pid']) \
+                        .filter(content_model=Page.PAGE_CMODEL_PATTERN) \
+                        .field_limit(['pid', 'isConstituentOf'])
+        for result in pagequery:
+            if result.get('isConstituentOf'):
+                # volume page belongs to is indexed based on fedora relation
+                vol_pid = result['isConstituentOf'][0].replace('info:fedora/', '')
+                page_pid = result['pid']
+                break
+        else:
+            # not found in solr; fall back to fedora
+            # NOTE: type inferring repository needed to load pages as correct type
+            # of Page (v1.0 or v1.1)
+            repo = TypeInferringRepository()
+            page = repo.get_object(kwargs['pid'])
+            if not page.exists or not isinstance(page, Page):
+                raise Http404
+            vol_pid, page_pid = page.volume.pid, page.pid
+
         page_url = reverse(self.pattern_name,
-            kwargs={'vol_pid': page.volume.pid, 'pid': page.pid})
+            kwargs={'vol_pid': vol_pid, 'pid': page_pid})
         return ''.join([page_url, kwargs['path']])
 
 
@@ -820,21 +973,33 @@ class PageImage(ProxyView):
     image url independent of image handling implementations
     to be referenced in annotations and exports.'''
 
+    #: modes that scale the image on the long edge, and so need the
+    #: page object to determine image dimensions
+    sized_modes = ['thumbnail', 'mini-thumbnail', 'single-page']
+
     def get_redirect_url(self, *args, **kwargs):
-        repo = TypeInferringRepository()
-        page = repo.get_object(kwargs['pid'], type=Page)
+        if kwargs['mode'] in self.sized_modes:
+            repo = TypeInferringRepository()
+            page = repo.get_object(kwargs['pid'], type=Page)
+            iiif_img = page.iiif
+        else:
+            # full size, info, and tile urls are based only on the pid;
+            # skip loading the page from fedora and the image metadata
+            # request needed for image dimensions (particularly
+            # important for HEAD requests and deep zoom tiles)
+            iiif_img = IIIFImage(pid=kwargs['pid'])
 
         if kwargs['mode'] == 'thumbnail':
-            return page.iiif.thumbnail()
+            return iiif_img.thumbnail()
         elif kwargs['mode'] == 'mini-thumbnail':
-            return page.iiif.mini_thumbnail()
+            return iiif_img.mini_thumbnail()
         elif kwargs['mode'] == 'single-page':
-            return page.iiif.page_size()
+            return iiif_img.page_size()
         elif kwargs['mode'] == 'fs':  # full size
-            return page.iiif
+            return iiif_img
         elif kwargs['mode'] == 'info':
             # TODO: needs an 'Access-Control-Allow-Origin' header
             # to allow jekyll sites to use for deep zoom
-            return page.iiif.info()
+            return iiif_img.info()
         elif kwargs['mode'] == 'iiif':
-            return page.iiif.info().replace('info.json', kwargs['url'].strip('/'))
+            return iiif_img.info().replace('info.json', kwargs['url'].strip('/'))
@@ -106,8 +106,10 @@ class CollectionDetail(DetailView, VaryOnCookieMixin):
             domain = get_current_site(self.request).domain.rstrip('/')
             if not domain.startswith('http'):
                 domain = 'http://' + domain
-            annotated_volumes = dict([(k.replace(domain, ''), v)
-                 for k, v in notes.iteritems()])
+            prefix_len = len(domain)
+            annotated_volumes = {
+                (k[prefix_len:] if k.startswith(domain) else k): v
+                for k, v in notes.iteritems()}
         else:
             annotated_volumes = {}
 